@@ -1,2 +0,0 @@
-import crm
-import openerp
@@ -1,14 +1,110 @@
 import pymssql
 import ConfigParser
+import cPickle
+import hashlib
 import os
 import logging
+import time
+import zlib
+from ringo import compactRows, Row, RowSchema
 
 _logger = logging.getLogger(__name__)
 
+class QueryCache:
+    """ Local snapshot cache for CRM query results, keyed by a hash of the
+        source database (host and database name), the SQL text and the
+        parameters, so one directory can serve several CRM servers. Each
+        result is stored column by column (a list of values per column,
+        pickled and zlib compressed), which packs far tighter than a list of
+        row dicts. Snapshots older than max_age seconds are ignored and
+        replaced on the next query, as are snapshots which cannot be read
+        back (truncated, corrupt or written in another format).
+
+        Enable it by passing a QueryCache to getCrmInformation, or for every
+        query by adding a [CACHE] section with 'directory' and optionally
+        'max_age' to config.cfg.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> cache = QueryCache(directory, max_age=60)
+    >>> cache.load('SELECT 1') is None
+    True
+    >>> cache.store('SELECT 1', None, ['a', 'b'], [(1, u'x'), (2, None)])
+    >>> cache.load('SELECT 1')
+    (('a', 'b'), [(1, u'x'), (2, None)])
+    >>> cache.load('SELECT 1', (2,)) is None
+    True
+    >>> cache.load('SELECT 1', source=('crm2', 'CRM')) is None
+    True
+    >>> with open(cache._path('SELECT 1', None, None), 'wb') as f:
+    ...     f.write('garbage')
+    >>> cache.load('SELECT 1') is None
+    True
+    >>> shutil.rmtree(directory)
+    """
+    def __init__(self, directory='.crm_cache', max_age=24 * 60 * 60):
+        self.directory = directory
+        self.max_age = max_age
+
+    @classmethod
+    def fromConfig(cls, config):
+        """ Return a QueryCache configured by the [CACHE] section of a
+            ConfigParser, or None if there is no such section.
+        """
+        if not config.has_section('CACHE'):
+            return None
+        max_age = (config.getint('CACHE', 'max_age')
+                   if config.has_option('CACHE', 'max_age')
+                   else 24 * 60 * 60)
+        return cls(config.get('CACHE', 'directory'), max_age)
+
+    def _path(self, query, params, source):
+        key = hashlib.sha1(repr((source, query, params))).hexdigest()
+        return os.path.join(self.directory, key + '.snapshot')
+
+    def load(self, query, params=None, source=None):
+        """ Return (columns, rows) for a fresh snapshot of the query on
+            source, where rows is a list of value tuples, or None on a miss.
+        """
+        path = self._path(query, params, source)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, 'rb') as f:
+                snapshot = f.read()
+        except (OSError, IOError):
+            return None
+        try:
+            columns, data = cPickle.loads(zlib.decompress(snapshot))
+        except Exception, e:
+            _logger.warn("Ignoring unreadable CRM snapshot %s: %s", path, e)
+            return None
+        _logger.debug("Using cached CRM snapshot %s", path)
+        return columns, zip(*data) if data else []
+
+    def store(self, query, params, columns, rows, source=None):
+        """ Save a snapshot of the query's columns and row tuples. """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(query, params, source)
+        data = zip(*rows) if rows else []
+        snapshot = zlib.compress(cPickle.dumps((tuple(columns), data),
+                                               cPickle.HIGHEST_PROTOCOL))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(snapshot)
+        os.rename(path + '.tmp', path)
+
+def _makeRows(columns, tuples, compact):
+    """ Turn value tuples into dicts, or Rows if compact is True. """
+    if compact:
+        schema = RowSchema(columns)
+        return [Row(schema, values) for values in tuples]
+    return [dict(zip(columns, values)) for values in tuples]
+
 class MsCrmDb:
     """ Provides methods to get data from the CRM database
     """
-    def __init__(self):
+    def __init__(self, cache=None):
         os.environ['TDSVER'] = '7.0'
         config = ConfigParser.ConfigParser()
         config.read('config.cfg')
@@ -16,37 +112,100 @@ class MsCrmDb:
         self.user = config.get('CRM', 'user')
         self.password = config.get('CRM', 'password')
         self.database = config.get('CRM', 'database')
+        self.cache = cache or QueryCache.fromConfig(config)
 
-    def _getCursor(self):
+    def _getCursor(self, as_dict=True):
         self._connection = pymssql.connect(host=self.host,
                                            user=self.user,
                                            password=self.password,
                                            database=self.database,
-                                           as_dict=True,
+                                           as_dict=as_dict,
                                            charset='utf8',
                                            )
         return self._connection.cursor()
 
+    def _execute(self, cursor, query, params):
+        if params is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, params)
+
     def _closeCursor(self, cursor):
         cursor.close()
         self._connection.close()
 
-    def getQueryResult(self, query):
-        cursor = self._getCursor() 
-        cursor.execute(query)
+    def getQueryResult(self, query, compact=False, params=None):
+        """ Run the query and return all rows. Rows are dicts, or Rows
+            sharing one schema if compact is True. If a cache is set, a fresh
+            snapshot is used instead of querying CRM.
+        """
+        if self.cache:
+            source = (self.host, self.database)
+            snapshot = self.cache.load(query, params, source)
+            if snapshot is None:
+                cursor = self._getCursor(as_dict=False)
+                self._execute(cursor, query, params)
+                columns = [column[0] for column in cursor.description]
+                snapshot = columns, cursor.fetchall()
+                self._closeCursor(cursor)
+                self.cache.store(query, params, snapshot[0], snapshot[1],
+                                 source)
+            return _makeRows(snapshot[0], snapshot[1], compact)
+        cursor = self._getCursor(as_dict=not compact)
+        self._execute(cursor, query, params)
         result = cursor.fetchall()
+        if compact:
+            result = compactRows(cursor.description, result)
         self._closeCursor(cursor)
         return result
 
-def getCrmInformation(query):
-    """ Gets query information from CRM.
+    def iterQueryResult(self, query, compact=False, chunk_size=1000,
+                        params=None):
+        """ Run the query and yield its rows, fetching chunk_size rows at a
+            time instead of the whole result at once. With a cache set, the
+            whole result goes through getQueryResult so it can be stored.
+        """
+        if self.cache:
+            for row in self.getQueryResult(query, compact, params):
+                yield row
+            return
+        cursor = self._getCursor(as_dict=not compact)
+        try:
+            self._execute(cursor, query, params)
+            schema = RowSchema.fromDescription(cursor.description)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield Row(schema, row) if compact else row
+        finally:
+            self._closeCursor(cursor)
+
+def getCrmInformation(query, compact=False, params=None, cache=None):
+    """ Gets query information from CRM. With compact=True the rows are
+        tuple-backed ringo.Row objects instead of dicts, which saves a lot of
+        memory on wide queries. cache is an optional QueryCache.
 
     >>> getCrmInformation('''
     ...     SELECT Name FROM LogicSupplyMSCRM.dbo.RoleBase
     ...     WHERE RoleId='3C7CB75A-842D-42DA-A192-E4FE1E1195C9'
     ... ''')
     [{'Name': u'Sales'}]
+    >>> getCrmInformation('''
+    ...     SELECT Name FROM LogicSupplyMSCRM.dbo.RoleBase
+    ...     WHERE RoleId='3C7CB75A-842D-42DA-A192-E4FE1E1195C9'
+    ... ''', compact=True)
+    [Row({'Name': u'Sales'})]
     """
     _logger.debug("Retreiving records from CRM...")
-    msCrm = MsCrmDb()
-    return msCrm.getQueryResult(query)
+    msCrm = MsCrmDb(cache)
+    return msCrm.getQueryResult(query, compact=compact, params=params)
+
+def iterCrmInformation(query, compact=False, params=None, cache=None):
+    """ Like getCrmInformation, but yields the rows as they are fetched so
+        they can be fed into ringo.runPipeline.
+    """
+    _logger.debug("Streaming records from CRM...")
+    msCrm = MsCrmDb(cache)
+    return msCrm.iterQueryResult(query, compact=compact, params=params)
@@ -0,0 +1,135 @@
+import cPickle
+import csv
+import itertools
+import logging
+import mmap
+import os
+import struct
+from ringo import Row, RowSchema
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = 'RINGODUMP1\n'
+_length = struct.Struct('<I')
+
+def _mapFile(f):
+    """ Return a read-only memory map of the open file, or None if empty. """
+    if not os.fstat(f.fileno()).st_size:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def writeDump(path, rows, columns=None):
+    """ Write rows (dicts or Rows) to path in the binary dump format: a magic
+        line, then the column names and each row's values as length-prefixed
+        pickles. Pickling keeps the types pymssql returns (Decimal, datetime,
+        None), which CSV cannot. columns default to the keys of the first
+        row. Returns the number of rows written.
+
+        To take a CRM extract offline:
+
+            writeDump('projects.dump', iterCrmInformation(getQuery()))
+    """
+    rows = iter(rows)
+    first = list(itertools.islice(rows, 1))
+    if columns is None:
+        columns = list(first[0]) if first else []
+    columns = tuple(columns)
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for value in itertools.chain([columns], (
+                tuple(row.get(column) for column in columns)
+                for row in itertools.chain(first, rows))):
+            data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            f.write(_length.pack(len(data)))
+            f.write(data)
+            count += 1
+    return count - 1
+
+def iterDump(path, compact=False):
+    """ Yield the rows of a binary dump written by writeDump, as dicts or, if
+        compact is True, as Rows sharing one schema. The file is memory
+        mapped and unpickled one row at a time.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> writeDump(path, [{'Name': u'Foo', 'Qty': 3}, {'Name': None, 'Qty': 4}],
+    ...           columns=['Name', 'Qty'])
+    2
+    >>> list(iterDump(path)) == [{'Name': u'Foo', 'Qty': 3},
+    ...                          {'Name': None, 'Qty': 4}]
+    True
+    >>> [row['Qty'] for row in iterDump(path, compact=True)]
+    [3, 4]
+    >>> os.remove(path)
+    """
+    with open(path, 'rb') as f:
+        data = _mapFile(f)
+        if data is None or data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a ringo dump" % path)
+        try:
+            offset = len(MAGIC)
+            schema = None
+            while offset < len(data):
+                size, = _length.unpack_from(data, offset)
+                offset += _length.size
+                values = cPickle.loads(data[offset:offset + size])
+                offset += size
+                if schema is None:
+                    schema = RowSchema(values)
+                elif compact:
+                    yield Row(schema, values)
+                else:
+                    yield dict(zip(schema.names, values))
+        finally:
+            data.close()
+
+def iterCsv(path, compact=False, encoding='utf-8'):
+    """ Yield the rows of a CSV file with a header line, as dicts or Rows.
+        Values are decoded to unicode and empty fields become None, as NULL
+        columns are in CRM rows; all other values stay strings, so numeric
+        converters must accept them.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> with open(path, 'wb') as f:
+    ...     f.write('Name,Note\\nFoo,"two\\nlines"\\nBar,\\n')
+    >>> rows = list(iterCsv(path, compact=True))
+    >>> rows == [{'Name': u'Foo', 'Note': u'two\\nlines'},
+    ...          {'Name': u'Bar', 'Note': None}]
+    True
+    >>> os.remove(path)
+    """
+    with open(path, 'rb') as f:
+        data = _mapFile(f)
+        if data is None:
+            return
+        try:
+            reader = csv.reader(iter(data.readline, ''))
+            schema = RowSchema(column.decode(encoding)
+                               for column in next(reader))
+            for line in reader:
+                values = tuple(value.decode(encoding) if value else None
+                               for value in line)
+                if compact:
+                    yield Row(schema, values)
+                else:
+                    yield dict(zip(schema.names, values))
+        finally:
+            data.close()
+
+def iterFileInformation(path, compact=False):
+    """ Yield rows from a CRM extract saved to path, like iterCrmInformation
+        does from the database. Files ending in .csv are read as CSV, all
+        others as binary dumps.
+    """
+    _logger.debug("Reading records from %s...", path)
+    if path.lower().endswith('.csv'):
+        return iterCsv(path, compact=compact)
+    return iterDump(path, compact=compact)
+
+def getFileInformation(path, compact=False):
+    """ Return all rows from a CRM extract saved to path, like
+        getCrmInformation does from the database.
+    """
+    return list(iterFileInformation(path, compact=compact))
@@ -8,14 +8,327 @@
 # Date: 2013-06-21
 
 import erppeek
+import collections
+import errno
 import logging
+import httplib
+import socket
+import threading
+import sys
+import time
+import Queue
+import gzip
+import json
+import xmlrpclib
+from StringIO import StringIO
+from xmlrpclib import Fault, ProtocolError
 
 _logger = logging.getLogger(__name__)
 
-openErpHandler = erppeek.Client('http://localhost:17069',
-                                db='bc_user_testing',
-                                user='inc',
-                                password='inc')
+SERVER = 'http://localhost:17069'
+DATABASE = 'bc_user_testing'
+USER = 'inc'
+PASSWORD = 'inc'
+TRANSPORT = None
+# Size in bytes above which requests are gzipped, or None to never compress
+COMPRESS_THRESHOLD = None
+
+################
+## Transports ##
+################
+
+class KeepAliveTransport(xmlrpclib.Transport, object):
+    """ XML-RPC transport which keeps one persistent HTTP(S) connection per
+        thread. Responses are always accepted gzipped. Request bodies larger
+        than compress_threshold bytes are gzipped too, but only if a
+        threshold is given: OpenERP's /xmlrpc handler reads the body as is,
+        ignoring Content-Encoding, so compressed requests only work when a
+        proxy in front of the server decompresses them.
+
+        The stdlib transport caches a single connection shared by every
+        thread; here the cache lives in a threading.local, so one client can
+        be used from several threads without them trampling each other's
+        connection.
+    """
+    def __init__(self, use_datetime=0, use_https=False,
+                 compress_threshold=None):
+        self._local = threading.local()
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.use_https = use_https
+        self.encode_threshold = compress_threshold
+
+    @property
+    def _connection(self):
+        return getattr(self._local, 'connection', (None, None))
+
+    @_connection.setter
+    def _connection(self, value):
+        self._local.connection = value
+
+    @property
+    def _extra_headers(self):
+        return getattr(self._local, 'extra_headers', [])
+
+    @_extra_headers.setter
+    def _extra_headers(self, value):
+        self._local.extra_headers = value
+
+    def make_connection(self, host):
+        if self._connection[1] and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        if self.use_https:
+            connection = httplib.HTTPSConnection(chost, None, **(x509 or {}))
+        else:
+            connection = httplib.HTTPConnection(chost)
+        self._connection = host, connection
+        return connection
+
+class JsonRpcTransport(KeepAliveTransport):
+    """ Transport which sends calls to the server's /jsonrpc endpoint instead
+        of /xmlrpc/<service>, for servers that provide it (OpenERP 8 and
+        later). erppeek still speaks XML-RPC to the transport; each request is
+        translated to a JSON-RPC call and the answer back to a result tuple,
+        so the JSON payload is what goes over the wire.
+    """
+    path = '/jsonrpc'
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        params, method = xmlrpclib.loads(request_body)
+        body = json.dumps({
+            'jsonrpc': '2.0',
+            'method': 'call',
+            'params': {'service': handler.rstrip('/').rsplit('/', 1)[-1],
+                       'method': method,
+                       'args': params},
+            'id': None,
+        }, default=str)
+        connection = self.make_connection(host)
+        if verbose:
+            connection.set_debuglevel(1)
+        try:
+            connection.putrequest('POST', self.path)
+            connection.putheader('Accept-Encoding', 'gzip')
+            self.send_host(connection, host)
+            self.send_user_agent(connection)
+            connection.putheader('Content-Type', 'application/json')
+            if (self.encode_threshold is not None and
+                self.encode_threshold < len(body)):
+                connection.putheader('Content-Encoding', 'gzip')
+                body = xmlrpclib.gzip_encode(body)
+            connection.putheader('Content-Length', str(len(body)))
+            connection.endheaders(body)
+            response = connection.getresponse(buffering=True)
+            data = response.read()
+        except Exception:
+            self.close()
+            raise
+        if response.status != 200:
+            raise ProtocolError(host + self.path, response.status,
+                                response.reason, response.msg)
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        answer = json.loads(data)
+        error = answer.get('error')
+        if error:
+            details = error.get('data') or {}
+            raise Fault(details.get('fault_code') or error.get('code'),
+                        details.get('message') or error.get('message'))
+        return (answer.get('result'),)
+
+def makeTransport(kind=None, server=SERVER,
+                  compress_threshold=COMPRESS_THRESHOLD):
+    """ Return a transport for erppeek given its kind: None or 'keepalive'
+        for XML-RPC, or 'jsonrpc' for JsonRpcTransport. All of them keep one
+        connection per thread, so a client can be shared by concurrent jobs.
+        Requests are only compressed if compress_threshold is given; see
+        KeepAliveTransport.
+
+    >>> makeTransport('keepalive').encode_threshold is None
+    True
+    >>> makeTransport('jsonrpc', compress_threshold=1024).encode_threshold
+    1024
+    >>> makeTransport('keepalive', 'https://erp.example.com').use_https
+    True
+    """
+    transports = {
+        None: KeepAliveTransport,
+        'keepalive': KeepAliveTransport,
+        'jsonrpc': JsonRpcTransport,
+    }
+    return transports[kind](use_https=server.startswith('https'),
+                            compress_threshold=compress_threshold)
+
+def getHandler(server=SERVER, db=DATABASE, user=USER, password=PASSWORD,
+               transport=TRANSPORT):
+    """ Return a new, logged in erppeek client. transport is a transport kind
+        as accepted by makeTransport().
+    """
+    return erppeek.Client(server, db=db, user=user, password=password,
+                          transport=makeTransport(transport, server))
+
+openErpHandler = getHandler()
+
+# Errors that mean the server (or the network) is struggling, as opposed to a
+# Fault, which means the server rejected this particular call.
+TRANSPORT_ERRORS = (socket.error, httplib.HTTPException, ProtocolError)
+
+##################
+## Handler pool ##
+##################
+
+class _Endpoint(object):
+    """ One OpenERP server in a HandlerPool. """
+    def __init__(self, server):
+        self.server = server
+        self.handler = None
+        self.outstanding = 0
+        self.down_until = 0
+        self.lock = threading.Lock()
+
+class HandlerPool(object):
+    """ Spreads calls over several OpenERP servers sharing one database, e.g.
+        worker processes listening on different ports. Has the same create,
+        write, unlink, read, search and execute methods as an erppeek client,
+        so it can be passed as the handler to the data functions or returned
+        by a WriteScheduler handlerFactory.
+
+        strategy is 'round-robin' or 'least-outstanding' (the endpoint with
+        the fewest calls in flight). An endpoint that fails with a transport
+        error is taken out of rotation for retry_after seconds and the call is
+        retried on the next one. A create, or an execute (which may run any
+        model method), is only retried if it cannot have reached the server
+        (the login or the connection was refused); otherwise the error is
+        raised, since a retry could create a duplicate record.
+
+        Calls on a record created through the pool go to the endpoint that
+        created it, so a read always sees the writes made before it. Only the
+        max_affinity most recently used records are remembered; older ones go
+        to any endpoint, by which time their writes are long committed.
+
+        Endpoints share one client between threads, so the default transport
+        is the thread-safe 'keepalive' one.
+
+    >>> pool = HandlerPool(['http://localhost:17069',
+    ...                     'http://localhost:17070'])
+    >>> id = pool.create('crm.lead', {'name': 'Testing'})
+    >>> pool.read('crm.lead', id, 'name')
+    'Testing'
+    >>> pool.execute('crm.lead', 'search_count', [('id', '=', id)])
+    1
+    >>> pool.unlink('crm.lead', id)
+    True
+    """
+    def __init__(self, servers, db=DATABASE, user=USER, password=PASSWORD,
+                 transport='keepalive', strategy='round-robin',
+                 retry_after=30.0, max_affinity=10000):
+        assert strategy in ('round-robin', 'least-outstanding')
+        assert servers, "HandlerPool needs at least one server"
+        self.endpoints = [_Endpoint(server) for server in servers]
+        self.db = db
+        self.user = user
+        self.password = password
+        self.transport = transport
+        self.strategy = strategy
+        self.retry_after = retry_after
+        self.max_affinity = max_affinity
+        self._affinity = collections.OrderedDict()
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def create(self, model, vals, *args, **kwargs):
+        endpoint, id = self._call(None, 'create', model, vals, *args, **kwargs)
+        with self._lock:
+            self._affinity[(model, id)] = endpoint
+            if len(self._affinity) > self.max_affinity:
+                self._affinity.popitem(last=False)
+        return id
+
+    def write(self, model, ids, *args, **kwargs):
+        return self._call(self._key(model, ids), 'write', model, ids,
+                          *args, **kwargs)[1]
+
+    def unlink(self, model, ids, *args, **kwargs):
+        key = self._key(model, ids)
+        result = self._call(key, 'unlink', model, ids, *args, **kwargs)[1]
+        with self._lock:
+            self._affinity.pop(key, None)
+        return result
+
+    def read(self, model, ids, *args, **kwargs):
+        return self._call(self._key(model, ids), 'read', model, ids,
+                          *args, **kwargs)[1]
+
+    def search(self, model, *args, **kwargs):
+        return self._call(None, 'search', model, *args, **kwargs)[1]
+
+    def execute(self, model, method, *args, **kwargs):
+        return self._call(None, 'execute', model, method, *args, **kwargs)[1]
+
+    def _key(self, model, ids):
+        """ Affinity key: the model and the (first) record id. """
+        if isinstance(ids, (list, tuple)):
+            ids = ids[0] if ids else None
+        return (model, ids)
+
+    def _select(self, key, exclude):
+        """ Pick an endpoint for the call, preferring the one holding key. """
+        now = time.time()
+        with self._lock:
+            endpoint = self._affinity.pop(key, None)
+            if endpoint:
+                # re-insert, so the least recently used record goes first
+                self._affinity[key] = endpoint
+            if (endpoint and endpoint not in exclude and
+                endpoint.down_until <= now):
+                endpoint.outstanding += 1
+                return endpoint
+            candidates = [e for e in self.endpoints if e not in exclude]
+            healthy = [e for e in candidates if e.down_until <= now]
+            candidates = healthy or candidates
+            if not candidates:
+                return None
+            if self.strategy == 'least-outstanding':
+                endpoint = min(candidates, key=lambda e: e.outstanding)
+            else:
+                endpoint = candidates[self._next % len(candidates)]
+                self._next += 1
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _handler(self, endpoint):
+        if endpoint.handler is None:
+            with endpoint.lock:
+                if endpoint.handler is None:
+                    endpoint.handler = getHandler(endpoint.server, self.db,
+                                                  self.user, self.password,
+                                                  self.transport)
+        return endpoint.handler
+
+    def _call(self, key, method, *args, **kwargs):
+        """ Run the call, failing over on transport errors. Returns the
+            endpoint that answered and the result.
+        """
+        tried = []
+        for _ in self.endpoints:
+            endpoint = self._select(key, tried)
+            handler = None
+            try:
+                handler = self._handler(endpoint)
+                return endpoint, getattr(handler, method)(*args, **kwargs)
+            except TRANSPORT_ERRORS, e:
+                _logger.warn("Taking %s out of rotation for %ss: %s",
+                             endpoint.server, self.retry_after, e)
+                endpoint.down_until = time.time() + self.retry_after
+                if (method in ('create', 'execute') and handler is not None and
+                    getattr(e, 'errno', None) != errno.ECONNREFUSED):
+                    raise
+                tried.append(endpoint)
+                error = e
+            finally:
+                with self._lock:
+                    endpoint.outstanding -= 1
+        raise error
 
 ####################
 ## Data functions ##
@@ -72,6 +385,11 @@ def searchRecord(model, domain, handler=openErpHandler):
     _logger.debug("Searching for object %s with domain %s", model, domain)
     return handler.search(model, domain)
 
+def countRecords(model, domain, handler=openErpHandler):
+    """ Return the number of objects of model matching domain. """
+    _logger.debug("Counting object %s with domain %s", model, domain)
+    return handler.execute(model, 'search_count', domain)
+
 def deleteRecord(model, id, handler=openErpHandler):
     """ Delete an OpenERP object with the given model and ids.
     """
@@ -82,4 +400,224 @@ def readRecord(model, id, fields=None, handler=openErpHandler):
     """ Read values from an OpenERP object with the given model and id
     """
     _logger.debug("Reading object %s with id %s", model, id)
-    return handler.read(model, id, fields=None)
+    return handler.read(model, id, fields=fields)
+
+def iterRecords(model, domain, fields=None, page_size=1000,
+                handler=openErpHandler):
+    """ Yield the records of model matching domain as dicts holding only the
+        given fields (plus 'id'), page_size records at a time. Pages are
+        keyed on id rather than offset, so each search stays cheap and
+        records created during the iteration cannot shift the pages.
+
+    >>> handler = erppeek.Client('http://localhost:17069',
+    ...                         db='bc_connector_test',
+    ...                         user='inc',
+    ...                         password='inc')
+    >>> users = iterRecords('res.users', [('login','=','admin')], ['login'],
+    ...                     handler=handler)
+    >>> [user['login'] for user in users]
+    ['admin']
+    """
+    _logger.debug("Iterating over object %s with domain %s", model, domain)
+    last_id = 0
+    while True:
+        ids = handler.search(model, list(domain) + [('id', '>', last_id)],
+                             limit=page_size, order='id')
+        if not ids:
+            return
+        for record in handler.read(model, ids, fields=fields):
+            yield record
+        if len(ids) < page_size:
+            return
+        last_id = ids[-1]
+
+
+#####################
+## Write scheduler ##
+#####################
+
+class WriteError(Exception):
+    """ Raised by WriteScheduler.run once every call has been made, if some
+        of them failed. results holds the result of each call (None for the
+        failed ones) and failures maps the index of each failed call to its
+        error.
+    """
+    def __init__(self, results, failures):
+        Exception.__init__(self, "%d of %d calls failed" % (len(failures),
+                                                            len(results)))
+        self.results = results
+        self.failures = failures
+
+class WriteScheduler(object):
+    """ Runs create/write calls against OpenERP in rounds, adapting the round
+        size (batch) and the number of parallel calls (concurrency) to the
+        observed latency and transport error rate, AIMD style: both grow
+        additively after a healthy round and are halved after an overloaded
+        one.
+
+        A round is overloaded if its mean call latency exceeds
+        target_latency or if any call failed with a transport error (timeout,
+        reset connection, HTTP error). Writes that failed that way are
+        retried in a later round, up to max_retries times, and the last error
+        is raised if they still fail. A create is only retried if it cannot
+        have reached the server (its client could not be built or the
+        connection was refused), as in HandlerPool: a create that timed out
+        may have been committed, and retrying it could create a duplicate.
+
+        A Fault, or a create that was not retried, fails only its own call;
+        the other calls go on, and WriteError is raised at the end with the
+        results and the failures. Any other error aborts the run and is
+        re-raised.
+
+        Each worker thread uses its own client built by handlerFactory, and
+        so its own connection.
+
+    >>> scheduler = WriteScheduler(max_concurrency=4, max_batch=50)
+    >>> ids = scheduler.writeRecords('crm.lead', [{'name': 'Testing'}])
+    >>> len(ids)
+    1
+    >>> openErpHandler.unlink('crm.lead', ids)
+    True
+    """
+    def __init__(self, handlerFactory=getHandler,
+                 min_concurrency=1, max_concurrency=8,
+                 min_batch=1, max_batch=200, batch_step=10,
+                 target_latency=2.0, max_retries=5, retry_delay=1.0):
+        self.handlerFactory = handlerFactory
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch_step = batch_step
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.concurrency = min_concurrency
+        self.batch = min_batch
+        self._handlers = Queue.Queue()
+
+    def writeRecords(self, model, records):
+        """ Create a record per vals dict and return the new ids in order. """
+        return self.run([('create', (model, vals)) for vals in records])
+
+    def updateRecords(self, model, updates):
+        """ Write vals to each (id, vals) pair in updates. """
+        return self.run([('write', (model, id, vals)) for id, vals in updates])
+
+    def run(self, calls):
+        """ Execute (method, args) calls on OpenERP clients and return their
+            results in the order given. Raises WriteError if any call
+            failed.
+        """
+        results = [None] * len(calls)
+        failures = {}
+        pending = [(i, 0) for i in range(len(calls))]
+        done = 0
+        while pending:
+            chunk, pending = pending[:self.batch], pending[self.batch:]
+            latencies, failed = self._runRound(calls, chunk, results,
+                                               failures)
+            done += len(chunk) - len(failed)
+            overloaded = bool(failed) or (
+                latencies and
+                sum(latencies) / len(latencies) > self.target_latency)
+            retried = False
+            for (i, attempts), (error, retry) in failed.items():
+                if not retry:
+                    _logger.error("Not retrying %s on %s, it may have been "
+                                  "written: %s", calls[i][0], calls[i][1][0],
+                                  error)
+                    failures[i] = error
+                elif attempts >= self.max_retries:
+                    raise error
+                else:
+                    pending.append((i, attempts + 1))
+                    retried = True
+            self._adapt(overloaded)
+            _logger.debug("Wrote %d of %d records (batch %d, concurrency %d)",
+                          done, len(calls), self.batch, self.concurrency)
+            if retried:
+                time.sleep(self.retry_delay)
+        if failures:
+            raise WriteError(results, failures)
+        return results
+
+    def _adapt(self, overloaded):
+        """ Additive increase, multiplicative decrease. """
+        if overloaded:
+            self.batch = max(self.min_batch, self.batch // 2)
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        else:
+            self.batch = min(self.max_batch, self.batch + self.batch_step)
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def _getHandler(self):
+        try:
+            return self._handlers.get_nowait()
+        except Queue.Empty:
+            return self.handlerFactory()
+
+    def _runRound(self, calls, chunk, results, failures):
+        """ Run one round of calls on self.concurrency threads. Faults are
+            added to failures. Returns the latencies of the calls that
+            reached the server and a dict of (index, attempts) -> (transport
+            error, whether the call may be retried) for those that did not,
+            including calls whose client could not be built. Any other error
+            stops the round and is re-raised here.
+        """
+        tasks = Queue.Queue()
+        for task in chunk:
+            tasks.put(task)
+        latencies = []
+        failed = {}
+        errors = []
+        lock = threading.Lock()
+
+        def work():
+            handler = None
+            try:
+                while not errors:
+                    try:
+                        i, attempts = tasks.get_nowait()
+                    except Queue.Empty:
+                        return
+                    method, args = calls[i]
+                    start = time.time()
+                    sent = False
+                    try:
+                        if handler is None:
+                            handler = self._getHandler()
+                        sent = True
+                        results[i] = getattr(handler, method)(*args)
+                    except Fault, e:
+                        _logger.warn("Error in %s %s: %s", method, args[0],
+                                     e.faultString)
+                        with lock:
+                            failures[i] = e
+                    except TRANSPORT_ERRORS, e:
+                        retry = (method != 'create' or not sent or
+                                 getattr(e, 'errno', None) ==
+                                 errno.ECONNREFUSED)
+                        with lock:
+                            failed[(i, attempts)] = e, retry
+                        continue
+                    except Exception:
+                        with lock:
+                            errors.append(sys.exc_info())
+                        return
+                    with lock:
+                        latencies.append(time.time() - start)
+            finally:
+                if handler is not None:
+                    self._handlers.put(handler)
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(self.concurrency, len(chunk)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            error = errors[0]
+            raise error[0], error[1], error[2]
+        return latencies, failed
@@ -3,7 +3,7 @@
 import ringo
 from adapters.openerp import (deleteRecord,
                               searchRecord,
-                              readRecord)
+                              iterRecords)
 from xmlrpclib import Fault
 import logging
 
@@ -11,7 +11,10 @@ _logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
     # Find attached records
-    partnerIdsWithInvoices = readRecord('account.invoice', [], fields='partner_id')
+    partnerIdsWithInvoices = set(
+        invoice['partner_id'][0]
+        for invoice in iterRecords('account.invoice', [], ['partner_id'])
+        if invoice['partner_id'])
 
     # Find all records
     allIds = searchRecord('res.partner', [('customer','=','True')])
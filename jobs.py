@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+from ringo import Job, runJobs
+from partners import importPartners
+from notes import importNotes
+from projects import importProjects
+import logging
+import sys
+
+_logger = logging.getLogger(__name__)
+
+def getJobs(create=False):
+    """ Return the import jobs; create is passed on to importPartners.
+        Notes and projects both look partners up by name, so they run once
+        the partners are in OpenERP, concurrently, sharing the partner
+        lookup caches the partners job seeded.
+    """
+    return [
+        Job('partners', lambda results: importPartners(create)),
+        Job('notes', lambda results: importNotes(),
+            requires=['partners']),
+        Job('projects', lambda results: importProjects(),
+            requires=['partners']),
+    ]
+
+if __name__ == '__main__':
+    _logger.info("Beginning CRM import...")
+    runJobs(getJobs(create='--create' in sys.argv))
@@ -7,9 +7,12 @@ from ringo import (ObjectNotFoundError,
                    dictFilter,
                    memoized)
 from adapters.crm import getCrmInformation
+from partners import getPartnerIdForName
 from adapters.openerp import (writeRecord,
                               searchRecord,
-                              updateRecord)
+                              updateRecord,
+                              WriteScheduler,
+                              WriteError)
 import logging
 import sys
 
@@ -34,18 +37,14 @@ def extractUniqueNames(records):
             names.add(record.get('Name'))
     return names
 
-@memoized
-def getPartnerIdForName(name):
-    ids = searchRecord('res.partner', [('name','=', name)])
-    return ids[0] if ids else False
-
 def notesWithName(name, records):
     notes = [ x.get('note') for x in records if x.get('Name') == name ]
     return "\n\n---------------------\n\n".join(notes)
 
-if __name__ == '__main__':
+def importNotes():
+    """ Import CRM notes into the comments of their partners. """
     _logger.info("Beginning import of CRM notes...")
-    records = getCrmInformation(getQuery())
+    records = getCrmInformation(getQuery(), compact=True)
 
     # Concatenate Subject and NoteText fields
     shouldConcatenate = lambda k: k in ['Subject', 'NoteText']
@@ -61,15 +60,16 @@ if __name__ == '__main__':
                           for name in uniqueNames 
                           if getPartnerIdForName(name)]
 
-    total = len(translatedRecords)
-    processed = 0
-    skipped = 0
-    _logger.info("Writing %d records to OpenERP...", len(records))
-    for record in translatedRecords:
-        processed += 1
-        print "{}Importing {} of {} ({} duplicates)".format("\r", processed, total, skipped),
-        sys.stdout.flush()
-        updateRecord(
-            'res.partner', 
-            record.get('partner_id'), 
-            {'comment': record.get('internal_notes')})
+    _logger.info("Writing %d records to OpenERP...", len(translatedRecords))
+    try:
+        WriteScheduler().updateRecords(
+            'res.partner',
+            [(record.get('partner_id'),
+              {'comment': record.get('internal_notes')})
+             for record in translatedRecords])
+    except WriteError, e:
+        _logger.error("Failed to write notes for %d of %d partners.",
+                      len(e.failures), len(translatedRecords))
+
+if __name__ == '__main__':
+    importNotes()
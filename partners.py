@@ -5,11 +5,15 @@ from ringo import (ObjectNotFoundError,
                    keyMap,
                    dictGlob,
                    dictFilter,
-                   memoized)
+                   memoized,
+                   FieldMapping,
+                   BloomFilter)
 from adapters.crm import getCrmInformation
 from adapters.openerp import (writeRecord,
                               updateRecord,
-                              searchRecord)
+                              searchRecord,
+                              countRecords,
+                              iterRecords)
 import logging
 import sys
 
@@ -41,53 +45,39 @@ def getCustomerDepositAcctId():
     return searchRecord('account.account', [('code', '=', '21511-02')])[0]
 
 @memoized
-def translateValue(key, value):
-    """ Translate the value based on the given key. The function_lookup dict
-        returns a reference to an inner function given a key, which then
-        operates on the value. If the key does not exist in function_lookup,
-        use the dummy function idem(x) = x.
+def getCountryId(name):
+    """ Return the OpenERP id of the country with the given name. """
+    ids = searchRecord('res.country',[('name', '=', name)])
+    return ids[0] if ids else 0
 
-        See 'testMemoizedFunctions()' for doctests.
-    """
-    def _doctest_false(value):
-        return False
+@memoized
+def getStateId(name):
+    """ Return the OpenERP id of the state with the given name. """
+    ids = searchRecord('res.country.state',[('name', '=', name)])
+    return ids[0] if ids else 0
 
-    def getCountryId(name):
-        """ Return the OpenERP id of the country with the given name. See
-            'testMemoizedFunctions()' for doctests.
-        """
-        ids = searchRecord('res.country',[('name', '=', name)])
-        return ids[0] if ids else 0
-
-    def getStateId(name):
-        """ Return the OpenERP id of the state with the given name. See
-            'testMemoizedFunctions()' for doctests.
-        """
-        ids = searchRecord('res.country.state',[('name', '=', name)])
-        return ids[0] if ids else 0
-
-    def fixEncoding(name):
-        return name
-
-    def getUserId(name):
-        """ Search for an OpenERP user with the given name and return his or 
-            her uid.
-        >>> searchUser('Administrator')
-        [1]
-        >>> searchUser('The Hamburgerlar')
-        """
-        uid = searchRecord('res.users', [('name','=',name)])
-        return uid[0] if uid else False
-
-    idem = lambda x: x
-    function_lookup = {
-        '_doctest_false': _doctest_false,
-        'country': getCountryId,
-        'state': getStateId,
-        'name': fixEncoding,
-        'user_id': getUserId
-        }
-    return function_lookup.get(key, idem)(value)
+@memoized
+def getUserId(name):
+    """ Search for an OpenERP user with the given name and return his or
+        her uid.
+    """
+    uid = searchRecord('res.users', [('name','=',name)])
+    return uid[0] if uid else False
+
+# Query column -> (OpenERP key, value converter)
+FIELD_MAPPING = {
+    'name': 'name',
+    'street': 'street',
+    'city': 'city',
+    'state': ('state', getStateId),
+    'country': ('country', getCountryId),
+    'zip': 'zip',
+    'phone': 'phone',
+    'email': 'email',
+    'user_id': ('user_id', getUserId),
+}
+
+translateRecord = FieldMapping(FIELD_MAPPING, skip_empty=False)
 
 def getAdditionalFields():
     """ Return constant fields for OpenERP. """
@@ -100,8 +90,24 @@ def getAdditionalFields():
         'is_company': True,
     }
 
+@memoized
+def getPartnerNameIndex():
+    """ Return a BloomFilter of the names of all partners, loaded with one
+        paged read of the name column. Names it does not contain certainly
+        have no partner, so looking them up needs no search. Partners
+        created after it is loaded must be added to it.
+    """
+    count = countRecords('res.partner', [])
+    index = BloomFilter(count + count // 10 + 1000)
+    index.update(record['name']
+                 for record in iterRecords('res.partner', [], ['name']))
+    _logger.debug("Loaded %d partner names into the name index", count)
+    return index
+
 @memoized
 def getPartnerIdForName(name):
+    if name not in getPartnerNameIndex():
+        return False
     ids = searchRecord('res.partner', [('name','=',name)])
     return ids[0] if ids else False
 
@@ -122,10 +128,9 @@ def testMemoizedFunctions():
     """ Run doctests for memoized functions. Doctest will not run tests
         directly from decorated functions, but we can run them here.
 
-    >>> translateValue('_doctest_false', True)
-    False
-    >>> translateValue('some_other_key', 'value')
-    'value'
+    >>> translateRecord({'name': 'Foo', 'zip': None}) == {
+    ...     'name': 'Foo', 'zip': None}
+    True
 
     >>> partnerExists('Logic Supply, Inc.')
     True
@@ -144,39 +149,46 @@ def splitFilter(predicate, items):
             falseList.append(item)
     return trueList, falseList
 
-if __name__ == '__main__':
+def importPartners(create=False):
+    """ Import partners from CRM, updating those already in OpenERP. CRM
+        partners missing from OpenERP are only created if create is True.
+        Returns a dict of partner name -> OpenERP id for every partner
+        created or updated, and seeds the partner lookup caches with it so
+        later jobs in the same process find newly created partners.
+    """
     _logger.info("Beginning import of CRM partners...")
-    records = getCrmInformation(getQuery())
+    records = getCrmInformation(getQuery(), compact=True)
     additional_fields = getAdditionalFields()
 
     # translate keys and data from the query
-    translateToIds = lambda d: dataMap(d, translateValue)
-    records = map(translateToIds, records)
+    records = map(translateRecord, records)
 
     # Filter records corresponding to existing OpenERP partners
     noPartnerExists = lambda d: not partnerExists(d.get('name'))
     recordsToCreate, recordsToUpdate = splitFilter(noPartnerExists, records)
-
-    """
-    total = len(recordsToCreate)
-    processed = 0
-    skipped = 0
-    seen = set()
-    _logger.info("Creating %d records in OpenERP...", len(records))
-    for record in recordsToCreate:
-        processed += 1
-        print "{}Creating {} of {} ({} duplicates)".format("\r", processed, total, skipped),
-        sys.stdout.flush()
-        if record['name'] not in seen:
-            # Add extra fields for OpenERP
-            record.update(additional_fields)
-            # Write record to OpenERP 
-            writeRecord('res.partner', record)
-            # Add name to the cache to avoid duplicate records
-            seen.add(record['name'])
-        else:
-            skipped += 1
-    """
+    partnerIds = {}
+
+    if create:
+        total = len(recordsToCreate)
+        processed = 0
+        skipped = 0
+        seen = set()
+        _logger.info("Creating %d records in OpenERP...", total)
+        for record in recordsToCreate:
+            processed += 1
+            print "{}Creating {} of {} ({} duplicates)".format("\r", processed, total, skipped),
+            sys.stdout.flush()
+            if record['name'] not in seen:
+                # Add extra fields for OpenERP
+                record.update(additional_fields)
+                # Write record to OpenERP 
+                partnerIds[record['name']] = writeRecord('res.partner', record)
+                # Keep the name index current for partners created here
+                getPartnerNameIndex().add(record['name'])
+                # Add name to the cache to avoid duplicate records
+                seen.add(record['name'])
+            else:
+                skipped += 1
 
     total = len(recordsToUpdate)
     processed = 0
@@ -193,9 +205,15 @@ if __name__ == '__main__':
             # Write record to OpenERP 
             id = searchRecord('res.partner',[('name','=',record['name'])])
             updateRecord('res.partner', id, record)
+            partnerIds[record['name']] = id[0]
             # Add name to the cache to avoid duplicate records
             seen.add(record['name'])
         else:
             skipped += 1
-           
 
+    getPartnerIdForName.seed(partnerIds)
+    partnerExists.seed(dict.fromkeys(partnerIds, True))
+    return partnerIds
+
+if __name__ == '__main__':
+    importPartners(create='--create' in sys.argv)
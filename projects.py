@@ -4,10 +4,18 @@ from ringo import (ObjectNotFoundError,
                    dataMap,
                    keyMap,
                    dictGlob,
-                   memoized)
-from adapters.crm import getCrmInformation
+                   memoized,
+                   FieldMapping,
+                   runPipeline,
+                   Cast,
+                   CodeMap,
+                   Format)
+from adapters.crm import getCrmInformation, iterCrmInformation
+from partners import getPartnerIdForName, getUserId
 from adapters.openerp import (writeRecord,
-                              searchRecord)
+                              searchRecord,
+                              WriteScheduler,
+                              WriteError)
 import logging
 
 _logger = logging.getLogger(__name__)
@@ -94,154 +102,105 @@ def getAdditionalFields():
 ## Functions to map ##
 ######################
 
-def translateKey(key, value):
-    """ Translate the key from MsCRM to OpenERP. The key_lookup dict returns an
-        OpenERP key given a MsCRM key.
-
-    >>> translateKey('mscrm_key', 'some_value')
-    'openerp_key'
-
-    >>> translateKey('some_other_key', 'some_value')
-    False
+@memoized
+def getStageId(name):
+    """ Return the id of the crm.case.stage with the given name, or None. """
+    ids = searchRecord('crm.case.stage', [('name','=',name)])
+    return ids[0] if ids else None
+
+STAGE_NAMES = {
+    200000: 'Pre Sale',
+    200001: 'Prototyping',
+    200005: 'Forecasted',       # Mass Production
+    200008: 'Forecasted',       # One Time
+    2: 'On Hold',
+}
+
+PROBABILITY_CODES = {
+    200053: 90,
+    200054: 80,
+    200055: 65,
+    200056: 40,
+    200057: 20
+}
+
+def translateStageId(code):
+    """ Translate Status id in CRM to a crm.case.stage id in OpenERP. Unknown
+        codes and missing stages fall back to the 'New' stage.
     """
-    key_lookup = {
-        'mscrm_key' : 'openerp_key',
-        'New_AdditionalHW1IdName' : 'needs_3_storage',
-        'New_AdditionalHW2IdName' : 'needs_4_processor',
-        'New_AdditionalHW3IdName' : 'needs_5_psu',
-        'new_caseidName' : 'needs_2_case',
-        'New_ContactIdName' : 'contact_name',
-        'OwnerIdName' : 'user_id',
-        'CustomerIdName' : 'partner_id',
-        'Name' : 'name',
-        'Description' : 'needs_z_other',
-        'EstimatedValue' : 'planned_revenue',
-        'New_AmbientTemperatures' : 'needs_9_temp',
-        'New_Purchasing' : 'needs_a_purchasing',
-        'New_InputVoltage' : 'needs_b_voltage',
-        'New_PerformanceRequirementDetails' : 'needs_e_performance',
-        'New_IORequirements' : 'needs_7_io',
-        'New_SoftwareDetails' : 'needs_8_software',
-        'New_PerUnitCost' : 'needs_f_cost',
-        'New_ProjectDescription' : 'description',
-        'New_HWSpecs' : 'needs_c_add_hw',
-        'New_Developments' : 'needs_d_developments',
-        'New_CaseCostPrice' : 'needs_2_case_cost',
-        'New_Model':  'needs_1_mainboard',
-        'New_MainboardCostPrice' : 'needs_1_mainboard_cost',
-        'New_TotalQTY' : 'needs_6_qty',
-        'OpportunityRatingCode': 'probability',
-        'StatusCode' : 'stage_id'
-    }
-    return key_lookup.get(key, False)
+    return (getStageId(STAGE_NAMES[code]) if code in STAGE_NAMES else None
+            ) or getStageId('New')
 
-@memoized
-def translateValue(key, value):
-    """ Translate the value based on the given key. The function_lookup dict
-        returns a reference to an inner function given a key, which then
-        operates on the value. If the key does not exist in function_lookup,
-        use the dummy function idem(x) = x.
+# Translate probability from OpportunityRatingCode id in CRM to a numerical
+# probability.
+translateProbability = CodeMap(PROBABILITY_CODES, default=0)
 
-    >>> translateValue('_doctest_false', True)
-    False
-    >>> translateValue('some_other_key', 'value')
-    'value'
-    """
-    def _doctest_false(value):
-        return False
-
-    def searchUser(name):
-        """ Search for an OpenERP user with the given name and return his or 
-            her uid.
-        >>> searchUser('Administrator')
-        [1]
-        >>> searchUser('The Hamburgerlar')
-        """
-        uid = searchRecord('res.users', [('name','=',name)])
-        return uid[0] if uid else False
+# Format the cost (given as a float) as a string with two decimals.
+formatCost = Format('$%.2f')
 
-    def searchPartner(name):
-        """ Search for an OpenERP partner with the given name and return his or 
-            her uid.
-        """
-        pid = searchRecord('res.partner', [('name','=',name)])
-        return pid[0] if pid else False
+def sanitizeName(name):
+    return name or "Unknown"
 
-    def formatCost(cost):
-        """ Format the cost (given as a float) and return a string with two
-            decimals. 
+def labelled(label):
+    """ Return a converter which prefixes a value with the given label.
 
-        >>> formatCost(325.000000)
-        '$325.00'
-        """
-        return '$%.2f' % cost
-
-    def translateStageId(code):
-        """ Translate Status id in CRM to a crm.case.stage id in OpenERP. """
-        status_codes = {
-            200000 : # Pre Sale
-                searchRecord('crm.case.stage', [('name','=','Pre Sale')]),
-            200001 : # Prototyping
-                searchRecord('crm.case.stage', [('name','=','Prototyping')]),
-            200005 : # Mass Production
-                searchRecord('crm.case.stage', [('name','=','Forecasted')]),
-            200008 : # One Time
-                searchRecord('crm.case.stage', [('name','=','Forecasted')]),
-            2      : # On Hold
-                searchRecord('crm.case.stage', [('name','=','On Hold')]),
-        }
-        return (status_codes.get(code)[0] if status_codes.get(code) else
-                searchRecord('crm.case.stage', [('name','=','New')])[0])
-    
-    def translateProbability(code):
-        """ Translate probability from OpportunityRatingCode id in CRM to a
-            numerical probability. """
-        probability_codes = {
-            200053: 90,
-            200054: 80,
-            200055: 65,
-            200056: 40,
-            200057: 20
-        }
-        return probability_codes.get(code) or 0
-
-    def sanitizeName(name):
-        return name or "Unknown"
-
-    def addLabel(value, label):
-        """ Prefix a value with the given label. """
-        return "{}: {}".format(label, value)
-
-    idem = lambda x: x
-    function_lookup = {
-        '_doctest_false': _doctest_false,
-        'name': sanitizeName,
-        'needs_3_storage': lambda x: addLabel(x,'Storage'),
-        'needs_4_processor': lambda x: addLabel(x,'Processor'),
-        'needs_5_psu': lambda x: addLabel(x,'PSU'),
-        'needs_2_case': lambda x: addLabel(x,'Case'),
-        'needs_z_other': lambda x: addLabel(x,'Other'),
-        'needs_9_temp': lambda x: addLabel(x,'Temperature'),
-        'needs_a_purchasing': lambda x: addLabel(x,'Purchasing'),
-        'needs_b_voltage': lambda x: addLabel(x,'Voltage'),
-        'needs_e_performance': lambda x: addLabel(x,'Performance'),
-        'needs_7_io': lambda x: addLabel(x,'Input/Output'),
-        'needs_8_software': lambda x: addLabel(x,'Software/OS'),
-        'needs_f_cost': lambda x: addLabel(x,'Cost'),
-        'needs_c_add_hw': lambda x: addLabel(x,'Additional Hardware'),
-        'needs_d_developments': lambda x: addLabel(x,'Developments'),
-        'needs_1_mainboard': lambda x: addLabel(x,'Mainboard'),
-        'needs_6_qty': lambda x: addLabel(x,'Quantity'),
-        'needs_1_mainboard_cost': formatCost,
-        'needs_2_case_cost': formatCost,
-        'needs_f_cost': lambda x: addLabel(formatCost(x), 'Cost'),
-        'planned_revenue': lambda x: float(x),
-        'user_id': searchUser,
-        'partner_id': searchPartner,
-        'stage_id' : translateStageId,
-        'probability' : translateProbability,
-        }
-    return function_lookup.get(key, idem)(value)
+    >>> labelled('Storage')('1TB')
+    'Storage: 1TB'
+    """
+    return lambda value: "{}: {}".format(label, value)
+
+# MsCRM key -> (OpenERP key, value converter)
+FIELD_MAPPING = {
+    'New_AdditionalHW1IdName': ('needs_3_storage', labelled('Storage')),
+    'New_AdditionalHW2IdName': ('needs_4_processor', labelled('Processor')),
+    'New_AdditionalHW3IdName': ('needs_5_psu', labelled('PSU')),
+    'new_caseidName': ('needs_2_case', labelled('Case')),
+    'New_ContactIdName': 'contact_name',
+    'OwnerIdName': ('user_id', getUserId),
+    'CustomerIdName': ('partner_id', getPartnerIdForName),
+    'Name': ('name', sanitizeName),
+    'Description': ('needs_z_other', labelled('Other')),
+    'EstimatedValue': ('planned_revenue', Cast(float)),
+    'New_AmbientTemperatures': ('needs_9_temp', labelled('Temperature')),
+    'New_Purchasing': ('needs_a_purchasing', labelled('Purchasing')),
+    'New_InputVoltage': ('needs_b_voltage', labelled('Voltage')),
+    'New_PerformanceRequirementDetails': ('needs_e_performance',
+                                          labelled('Performance')),
+    'New_IORequirements': ('needs_7_io', labelled('Input/Output')),
+    'New_SoftwareDetails': ('needs_8_software', labelled('Software/OS')),
+    'New_PerUnitCost': ('needs_f_cost', Format('Cost: $%.2f')),
+    'New_ProjectDescription': 'description',
+    'New_HWSpecs': ('needs_c_add_hw', labelled('Additional Hardware')),
+    'New_Developments': ('needs_d_developments', labelled('Developments')),
+    'New_CaseCostPrice': ('needs_2_case_cost', formatCost),
+    'New_Model': ('needs_1_mainboard', labelled('Mainboard')),
+    'New_MainboardCostPrice': ('needs_1_mainboard_cost', formatCost),
+    'New_TotalQTY': ('needs_6_qty', labelled('Quantity')),
+    'OpportunityRatingCode': ('probability', translateProbability),
+    'StatusCode': ('stage_id', translateStageId),
+}
+
+translateRecord = FieldMapping(FIELD_MAPPING)
+
+def testFieldMapping():
+    """ Run doctests for the field mapping. Doctest does not collect tests
+        from FieldMapping instances, but we can run them here.
+
+    >>> translateRecord({'New_CaseCostPrice': 325.0, 'New_TotalQTY': 5,
+    ...                  'New_InputVoltage': None, 'AccountId': 'x'}) == {
+    ...     'needs_2_case_cost': '$325.00', 'needs_6_qty': 'Quantity: 5'}
+    True
+    >>> translateRecord.batch([{'New_PerUnitCost': 3, 'EstimatedValue': 10},
+    ...                        {'OpportunityRatingCode': 200055}]) == [
+    ...     {'needs_f_cost': 'Cost: $3.00', 'planned_revenue': 10.0},
+    ...     {'probability': 65}]
+    True
+    >>> formatCost(325.000000)
+    '$325.00'
+    >>> translateProbability(12345)
+    0
+    """
+    pass
 
 def isNeed(key):
     """ Returns True if the key should be globbed into the description of needs
@@ -281,38 +240,52 @@ def isMainboard(key):
 ## Main ##
 ##########
 
-if __name__ == '__main__':
-
+def importProjects():
+    """ Import CRM opportunities as crm.lead records. Returns the number of
+        records written.
+    """
     _logger.info("Beginning import of CRM projects...")
-    records = getCrmInformation(getQuery())
     additional_fields = getAdditionalFields()
 
-    # translate keys and data from the query
-    translateDict = lambda d: dataMap(keyMap(d,translateKey), translateValue)
-    records = map(translateDict, records)
-
     # Concatenate mainboard model and price
     globMainboard = lambda d: dictGlob(d, isMainboard, 'needs_1_mainboard',
                                        separator=": ")
-    records = map(globMainboard, records)
 
     # Concatenate case model and price
     globCase = lambda d: dictGlob(d, isCase, 'needs_2_case',
                                        separator=": ")
-    records = map(globCase, records)
 
     # Concatenate description of needs field
     globNeeds = lambda d: dictGlob(d, isNeed, 'description_of_needs')
-    records = map(globNeeds, records)
 
-
-    _logger.info("Writing records to OpenERP...")
-    total = len(records)
-    processed = 0
-    for record in records:
-        processed += 1
-        print "{}Importing {} of {}".format("\r", processed, total),
-        # Add extra fields for OpenERP
+    def addAdditionalFields(record):
+        """ Add extra fields for OpenERP """
         record.update(additional_fields)
-        writeRecord('crm.lead', record)
+        return record
+
+    # Read, translate and write records concurrently
+    scheduler = WriteScheduler()
+    failed = []
+
+    def writeRecords(records):
+        try:
+            scheduler.writeRecords('crm.lead', records)
+        except WriteError, e:
+            for i, error in sorted(e.failures.items()):
+                _logger.error("Could not create project %s: %s",
+                              records[i].get('name'), error)
+            failed.extend(e.failures)
+
+    total = runPipeline(
+        iterCrmInformation(getQuery(), compact=True),
+        [translateRecord, globMainboard, globCase, globNeeds,
+         addAdditionalFields],
+        writeRecords,
+        chunk_size=200,
+        batch_sink=True)
+    _logger.info("Wrote %d records to OpenERP, %d failed.",
+                 total - len(failed), len(failed))
+    return total - len(failed)
 
+if __name__ == '__main__':
+    importProjects()
@@ -7,10 +7,16 @@
 # Author: Brendan Clune
 # Date: 2013-06-21
 
-import erppeek
 import logging
 import collections
 import functools
+import hashlib
+import math
+import struct
+import itertools
+import sys
+import threading
+import Queue
 
 FORMAT='%(asctime)-14s%(levelname)-6s: %(name)s: %(message)s'
 DATEFORMAT='%(asctime)-14s%(name)s: %(levelname)s %(message)s'
@@ -25,13 +31,122 @@ _logger = logging.getLogger(__name__)
 class ObjectNotFoundError(Exception):
     pass
 
+##########
+## Rows ##
+##########
+
+class RowSchema(object):
+    """ Column layout shared by every Row of a query result. Holds the column
+        names in order and a name -> position index, so the key strings and
+        the hash table exist once per query instead of once per row.
+
+    >>> schema = RowSchema(['Name', 'City'])
+    >>> schema.names
+    ('Name', 'City')
+    >>> schema.index['City']
+    1
+    """
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+    @classmethod
+    def fromDescription(cls, description):
+        """ Build a schema from a DB-API cursor.description. """
+        return cls(column[0] for column in description)
+
+class Row(object):
+    """ A read-only, tuple-backed record. Behaves like a dict for the mappers
+        below (iteration, item access, get, in) while only storing a tuple of
+        values and a reference to the shared RowSchema.
+
+    >>> schema = RowSchema(['apples', 'oranges'])
+    >>> row = Row(schema, (3, 7))
+    >>> row['oranges']
+    7
+    >>> row.get('bananas', 0)
+    0
+    >>> list(row)
+    ['apples', 'oranges']
+    >>> row == {'apples': 3, 'oranges': 7}
+    True
+    """
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._schema.index[key]]
+
+    def get(self, key, default=None):
+        i = self._schema.index.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key):
+        return key in self._schema.index
+
+    def __iter__(self):
+        return iter(self._schema.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._schema.names)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._schema.names, self._values)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def asDict(self):
+        """ Return a plain dict copy of the row. """
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.asDict()
+        return self.asDict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Row(%r)' % self.asDict()
+
+collections.Mapping.register(Row)
+
+def compactRows(description, tuples):
+    """ Wrap DB-API result tuples in Rows sharing a single schema built from
+        cursor.description.
+
+    >>> rows = compactRows([('Name',), ('City',)], [('Foo', 'Paris'),
+    ...                                              ('Bar', 'Oslo')])
+    >>> [row['City'] for row in rows]
+    ['Paris', 'Oslo']
+    >>> rows[0]._schema is rows[1]._schema
+    True
+    """
+    schema = RowSchema.fromDescription(description)
+    return [Row(schema, values) for values in tuples]
+
 #############
 ## Mappers ##
 #############
 
 def keyMap(data, function):
-    """ Apply the transformation function to each key of the data dict and
-        return the result.
+    """ Apply the transformation function to each key of the data dict (or
+        Row) and return the result.
 
         The transformation function should accept a key, value pair as input
         and return keys of the new dict as output.
@@ -41,6 +156,12 @@ def keyMap(data, function):
     >>> (keyMap(fruits, crabify) ==
     ...  {'crabapples': 3, 'craboranges': 7, 'crabbananas': 9})
     True
+
+        Rows are accepted as well as dicts:
+
+    >>> row = Row(RowSchema(['apples', 'pears']), (3, None))
+    >>> keyMap(row, crabify)
+    {'crabapples': 3}
     """
     return {function(key, data[key]): data[key]
             for key in data
@@ -58,6 +179,8 @@ def dataMap(data, function):
     >>> (dataMap(fruits, squarify) ==
     ...  {'apples': 9, 'oranges': 49, 'bananas': 81})
     True
+    >>> dataMap(Row(RowSchema(['apples']), (3,)), squarify)
+    {'apples': 9}
     """
     return {key: function(key, data[key]) for key in data}
 
@@ -73,6 +196,10 @@ def dictGlob(data, function, globbed_key, separator="\n"):
     >>> sandwich = dictGlob(ingredients, isFilling, 'toppings', separator=',')
     >>> sandwich == {'bread': 'rye', 'toppings': 'lettuce,tomato,bacon'}
     True
+    >>> row = Row(RowSchema(['bread', 'filling_1']), ('rye', 'ham'))
+    >>> dictGlob(row, isFilling, 'toppings') == {'bread': 'rye',
+    ...                                           'toppings': 'ham'}
+    True
     """
     result = {}
     glob_keys = []
@@ -99,32 +226,485 @@ def dictFilter(data, function):
     >>> result = dictFilter(fruits, isRed)
     >>> result == {'tomato': 'red', 'apple': 'red'}
     True
+    >>> dictFilter(Row(RowSchema(['apple']), ('red',)), isRed)
+    {'apple': 'red'}
     """
     return {key: data[key] for key in data if function(key, data[key])}
 
 
+####################
+## Field mappings ##
+####################
+
+_missing = object()
+
+class FieldMapping(object):
+    """ A declarative mapping from source records to target dicts, compiled
+        once into a dispatch table. The spec maps each source key to either a
+        target key, or a (target key, converter) pair where converter is a
+        one argument function applied to the value.
+
+        Calling the mapping on a record (dict or Row) returns a new dict with
+        only the target keys. With skip_empty (the default) falsy source
+        values are dropped, as keyMap does; otherwise they are converted like
+        any other value. Source keys missing from the record are always
+        dropped.
+
+    >>> mapping = FieldMapping({'Name': 'name',
+    ...                         'Qty': ('quantity', int),
+    ...                         'Note': ('note', lambda x: x.upper())})
+    >>> mapping({'Name': 'Foo', 'Qty': '3', 'Note': None, 'Other': 1}) == {
+    ...     'name': 'Foo', 'quantity': 3}
+    True
+    >>> mapping = FieldMapping({'Note': ('note', bool)}, skip_empty=False)
+    >>> mapping({'Note': None})
+    {'note': False}
+    """
+    def __init__(self, spec, skip_empty=True):
+        table = []
+        for source, target in spec.items():
+            if isinstance(target, tuple):
+                target, converter = target
+            else:
+                converter = None
+            table.append((source, target, converter))
+        self._table = tuple(table)
+        self._rowTable = tuple(entry for entry in table
+                               if not isinstance(entry[2], ColumnConverter))
+        self._columnTable = tuple(entry for entry in table
+                                  if isinstance(entry[2], ColumnConverter))
+        self.skip_empty = skip_empty
+
+    def __call__(self, record):
+        result = {}
+        get = record.get
+        skip_empty = self.skip_empty
+        for source, target, converter in self._table:
+            value = get(source, _missing)
+            if value is _missing or (skip_empty and not value):
+                continue
+            result[target] = converter(value) if converter else value
+        return result
+
+    def batch(self, records):
+        """ Map a list of records at once. Fields with a ColumnConverter are
+            gathered into one column per field and converted with a single
+            column() call; the others are converted value by value.
+
+        >>> mapping = FieldMapping({'Name': 'name',
+        ...                         'Value': ('revenue', Cast(float))})
+        >>> mapping.batch([{'Name': 'Foo', 'Value': 3}, {'Name': 'Bar'}]) == [
+        ...     {'name': 'Foo', 'revenue': 3.0}, {'name': 'Bar'}]
+        True
+        """
+        skip_empty = self.skip_empty
+        results = []
+        for record in records:
+            result = {}
+            get = record.get
+            for source, target, converter in self._rowTable:
+                value = get(source, _missing)
+                if value is _missing or (skip_empty and not value):
+                    continue
+                result[target] = converter(value) if converter else value
+            results.append(result)
+        for source, target, converter in self._columnTable:
+            values = [record.get(source, _missing) for record in records]
+            present = [i for i, value in enumerate(values)
+                       if value is not _missing and (value or not skip_empty)]
+            if len(present) < len(values):
+                values = [values[i] for i in present]
+            else:
+                present = xrange(len(values))
+            if values:
+                for i, value in itertools.izip(present,
+                                               converter.column(values)):
+                    results[i][target] = value
+        return results
+
+
+#######################
+## Column converters ##
+#######################
+
+class ColumnConverter(object):
+    """ A value converter which can also convert a whole column (a list of
+        values) at once. Subclasses convert one value in __call__ and may
+        override column() with a faster loop over the whole list; by default
+        column() calls the converter on each value.
+    """
+    def column(self, values):
+        return [self(value) for value in values]
+
+class Cast(ColumnConverter):
+    """ Cast values to float or int.
+
+    >>> Cast(float)('2.5')
+    2.5
+    >>> Cast(int).column([1.0, '2', 3])
+    [1, 2, 3]
+    >>> from decimal import Decimal
+    >>> Cast(float).column([Decimal('1.50'), 2])
+    [1.5, 2.0]
+    """
+    def __init__(self, type):
+        assert type in (float, int)
+        self.type = type
+
+    def __call__(self, value):
+        return self.type(value)
+
+    def column(self, values):
+        return map(self.type, values)
+
+class CodeMap(ColumnConverter):
+    """ Translate codes through a lookup table, falling back to default for
+        unknown codes (and codes mapped to a falsy value).
+
+    >>> ratings = CodeMap({1: 90, 2: 80}, default=0)
+    >>> ratings(2)
+    80
+    >>> ratings.column([1, 5, 2])
+    [90, 0, 80]
+    """
+    def __init__(self, table, default=None):
+        self.table = dict(table)
+        self.default = default
+
+    def __call__(self, value):
+        return self.table.get(value) or self.default
+
+    def column(self, values):
+        get = self.table.get
+        default = self.default
+        return [get(value) or default for value in values]
+
+class Format(ColumnConverter):
+    """ Format numbers with a %-style format string holding one
+        conversion.
+
+    >>> Format('$%.2f')(325)
+    '$325.00'
+    >>> Format('Cost: $%.2f').column([1, 2.5])
+    ['Cost: $1.00', 'Cost: $2.50']
+    """
+    def __init__(self, format):
+        self.format = format
+
+    def __call__(self, value):
+        return self.format % value
+
+    def column(self, values):
+        format = self.format
+        return [format % value for value in values]
+
+
+###############
+## Pipelines ##
+###############
+
+_done = object()
+
+def _put(queue, item, abort):
+    """ Put item on a bounded queue, giving up if the pipeline aborted. """
+    while not abort.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _get(queue, abort):
+    """ Get an item from a queue, returning _done if the pipeline aborted. """
+    while not abort.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    return _done
+
+def runPipeline(source, stages, sink, maxsize=4, chunk_size=100,
+                batch_sink=False):
+    """ Stream records from source through each stage into sink, with the
+        source and every stage running on their own thread and the sink on
+        the calling thread. The threads are connected by queues holding at
+        most maxsize chunks of chunk_size records, so extracting, mapping
+        and loading overlap while memory stays bounded.
+
+        Each stage is a function from record to record, as passed to map(),
+        or an object with a batch() method (such as a FieldMapping) which is
+        given each chunk as a list.
+        sink is called with each record, or with each chunk (a list) if
+        batch_sink is True. The first exception raised anywhere stops the
+        pipeline and is re-raised here. Returns the number of records sunk.
+
+    >>> sunk = []
+    >>> runPipeline(iter(range(5)), [lambda x: x * 2, str], sunk.append,
+    ...             chunk_size=2)
+    5
+    >>> sunk
+    ['0', '2', '4', '6', '8']
+    >>> runPipeline(range(5), [lambda x: 1 / (x - 3)], sunk.append)
+    Traceback (most recent call last):
+        ...
+    ZeroDivisionError: integer division or modulo by zero
+    """
+    abort = threading.Event()
+    errors = []
+    queues = [Queue.Queue(maxsize) for _ in range(len(stages) + 1)]
+
+    def guarded(function):
+        def run(*args):
+            try:
+                function(*args)
+            except Exception:
+                errors.append(sys.exc_info())
+                abort.set()
+        return run
+
+    def produce(out):
+        records = iter(source)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk or not _put(out, chunk, abort):
+                break
+        _put(out, _done, abort)
+
+    def transform(stage, inq, out):
+        while True:
+            chunk = _get(inq, abort)
+            if chunk is _done:
+                break
+            if hasattr(stage, 'batch'):
+                chunk = stage.batch(chunk)
+            else:
+                chunk = map(stage, chunk)
+            if not _put(out, chunk, abort):
+                return
+        _put(out, _done, abort)
+
+    threads = [threading.Thread(target=guarded(produce), args=(queues[0],))]
+    for stage, inq, out in zip(stages, queues, queues[1:]):
+        threads.append(threading.Thread(target=guarded(transform),
+                                        args=(stage, inq, out)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    count = 0
+    try:
+        while True:
+            chunk = _get(queues[-1], abort)
+            if chunk is _done:
+                break
+            if batch_sink:
+                sink(chunk)
+            else:
+                for record in chunk:
+                    sink(record)
+            count += len(chunk)
+    except Exception:
+        errors.append(sys.exc_info())
+        abort.set()
+    for thread in threads:
+        thread.join()
+    if errors:
+        error = errors[0]
+        raise error[0], error[1], error[2]
+    return count
+
+
+##########
+## Jobs ##
+##########
+
+class Job(object):
+    """ A named unit of work for runJobs. function is called with a dict
+        holding the results of the jobs named in requires.
+    """
+    def __init__(self, name, function, requires=()):
+        self.name = name
+        self.function = function
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return 'Job(%r)' % self.name
+
+def _checkJobs(jobs):
+    """ Raise ValueError on duplicate names, unknown requirements or cycles.
+
+    >>> _checkJobs([Job('a', None, ['b']), Job('b', None, ['a'])])
+    Traceback (most recent call last):
+        ...
+    ValueError: Dependency cycle between jobs: a, b
+    """
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate job names: %s" % ', '.join(names))
+    for job in jobs:
+        for name in job.requires:
+            if name not in names:
+                raise ValueError("Job %s requires unknown job %s" %
+                                 (job.name, name))
+    done = set()
+    remaining = list(jobs)
+    while remaining:
+        ready = [job for job in remaining if done.issuperset(job.requires)]
+        if not ready:
+            raise ValueError("Dependency cycle between jobs: %s" %
+                             ', '.join(sorted(job.name for job in remaining)))
+        done.update(job.name for job in ready)
+        remaining = [job for job in remaining if job.name not in done]
+
+def runJobs(jobs, max_workers=4):
+    """ Run jobs in one process, each on its own thread as soon as the jobs
+        it requires have finished, with at most max_workers at a time. Jobs
+        share the process, so they share memoized lookup caches and OpenERP
+        connections. Returns a dict of job name -> result.
+
+        If a job fails, no further jobs are started and the first error is
+        re-raised once the running ones have finished.
+
+    >>> log = []
+    >>> results = runJobs([
+    ...     Job('partners', lambda r: log.append('partners') or {'Foo': 1}),
+    ...     Job('notes', lambda r: r['partners']['Foo'] + 1, ['partners'])])
+    >>> results['notes'], log
+    (2, ['partners'])
+    >>> runJobs([Job('exit', lambda r: sys.exit(3))])
+    Traceback (most recent call last):
+    ...
+    SystemExit: 3
+    """
+    _checkJobs(jobs)
+    pending = list(jobs)
+    results = {}
+    errors = []
+    finished = Queue.Queue()
+    running = 0
+
+    def run(job):
+        # a bare except, so that even SystemExit or KeyboardInterrupt in a
+        # job reaches the main loop instead of leaving it waiting forever
+        try:
+            upstream = dict((name, results[name]) for name in job.requires)
+            finished.put((job, job.function(upstream), None))
+        except:
+            finished.put((job, None, sys.exc_info()))
+
+    while True:
+        ready = [job for job in pending
+                 if all(name in results for name in job.requires)]
+        for job in ready[:max_workers - running] if not errors else []:
+            _logger.info("Starting job %s", job.name)
+            pending.remove(job)
+            threading.Thread(target=run, args=(job,)).start()
+            running += 1
+        if not running:
+            break
+        job, result, error = finished.get()
+        running -= 1
+        if error:
+            _logger.error("Job %s failed: %s", job.name, error[1])
+            errors.append(error)
+        else:
+            _logger.info("Finished job %s", job.name)
+            results[job.name] = result
+    if errors:
+        error = errors[0]
+        raise error[0], error[1], error[2]
+    return results
+
+
 #####################
 ## Utility classes ##
 #####################
 
+class _Call(object):
+    """ A call in progress, shared by the threads waiting for its result. """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
 class memoized(object):
     """ Decorator. Caches the result of the function passed to it to speed up
-        database queries. """
+        database queries.
+
+        Safe to share between threads: concurrent calls with the same
+        arguments make a single call of the function and all get its result,
+        or its exception. Exceptions are not cached. A function must not call
+        itself with the same arguments, or it will wait for itself forever.
+
+    >>> calls = []
+    >>> release = threading.Event()
+    >>> def slowDouble(x):
+    ...     calls.append(x)
+    ...     release.wait()
+    ...     return x * 2
+    >>> double = memoized(slowDouble)
+    >>> threads = [threading.Thread(target=double, args=(1,))
+    ...            for _ in range(5)]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> release.set()
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> calls, double(1)
+    ([1], 2)
+    """
     def __init__(self, function):
         assert hasattr(function, '__call__')
         self.function = function
         self._cache = {}
+        self._calls = {}
+        self._lock = threading.Lock()
 
     def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
+        try:
+            hash(args)
+        except TypeError:
             # if we can't hash args, just call function
             return self.function(*args)
-        if args in self._cache:
-            return self._cache[args]
+        with self._lock:
+            if args in self._cache:
+                return self._cache[args]
+            call = self._calls.get(args)
+            waiting = call is not None
+            if not waiting:
+                call = self._calls[args] = _Call()
+        if waiting:
+            call.done.wait()
+            if call.error:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.value
+        try:
+            call.value = self.function(*args)
+        except:
+            call.error = sys.exc_info()
+            raise
         else:
-            value = self.function(*args)
-            self._cache[args] = value
-            return value
+            with self._lock:
+                self._cache[args] = call.value
+        finally:
+            with self._lock:
+                del self._calls[args]
+            call.done.set()
+        return call.value
+
+    def seed(self, results):
+        """ Pre-fill the cache of a one-argument function from a dict of
+            argument -> result, e.g. with ids another job just created.
+
+        >>> double = memoized(lambda x: x * 2)
+        >>> double.seed({3: 'six'})
+        >>> double(3), double(4)
+        ('six', 8)
+        """
+        with self._lock:
+            for arg, value in results.items():
+                self._cache[(arg,)] = value
 
     def __repr__(self):
         """ Return the function's docstring. """
@@ -133,5 +713,47 @@ class memoized(object):
     def __get__(self, obj, objtype):
         """ Support instance methods. """
         return functools.partial(self.__call__, obj)
-        
-    
+
+class BloomFilter(object):
+    """ Compact probabilistic set for existence checks. 'item in filter' is
+        False only if the item was never added; True means it probably was,
+        with a false positive rate of about error_rate once capacity items
+        have been added. Takes roughly 1.2 bytes per item at 1%.
+
+    >>> names = BloomFilter(1000)
+    >>> names.update([u'Logic Supply, Inc.', 'Acme'])
+    >>> u'Logic Supply, Inc.' in names, 'Acme' in names
+    (True, True)
+    >>> 'The Hamburgerlar' in names
+    False
+    >>> len(names.bits)
+    1199
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+                                       math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        elif not isinstance(item, str):
+            item = repr(item)
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
@@ -6,6 +6,7 @@ import projects
 import partners
 import adapters.openerp as openerp
 import adapters.crm as crm
+import adapters.dump as dump
 
 _logger = logging.getLogger(__name__)
 
@@ -19,6 +20,8 @@ def runAllTests():
     doctest.testmod(openerp)
     _logger.info('Testing crm:')
     doctest.testmod(crm)
+    _logger.info('Testing dump:')
+    doctest.testmod(dump)
     _logger.info('Testing partners:')
     doctest.testmod(partners, verbose=True)
 